@@ -7,77 +7,199 @@ Consumes temperature and vibration sensor data and stores it in BigQuery.
 import json
 import logging
 import os
-from concurrent.futures import TimeoutError
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core.exceptions import NotFound
 from google.cloud import pubsub_v1, bigquery
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 
+# orjson decodes message bytes directly, skipping the intermediate
+# str decode; fall back to the stdlib when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_loads(data):
+    """Parse JSON from bytes with the fastest available codec"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Batching configuration for BigQuery streaming inserts
+MAX_BATCH_SIZE = 500        # BigQuery recommends batches of up to 500 rows
+MAX_BATCH_AGE_SECONDS = 1.0  # Flush at least once per second on slow topics
+
 class IoTDataConsumer:
     def __init__(self, project_id, subscription_name):
         self.project_id = project_id
         self.subscription_name = subscription_name
         self.subscriber = pubsub_v1.SubscriberClient()
         self.subscription_path = self.subscriber.subscription_path(project_id, subscription_name)
-        self.bq_client = bigquery.Client(project=project_id)
+        self.bq_client = bigquery.Client(project=project_id, _http=self._build_http_session())
         self.dataset_id = "iot_data"
         self.table_id = "sensor_readings"
-        
+
+        # Resolve the table once instead of issuing a tables.get round trip
+        # on every insert; re-resolved on NotFound in _flush
+        self._table = self._resolve_table()
+
+        # Buffer rows and their source messages so inserts can be batched
+        # into a single insert_rows_json call instead of one RPC per message
+        self._buffer = []
+        self._pending_msgs = []
+        self._buffer_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._processed = 0
+
+        # Background timer so low-rate topics still see bounded latency
+        self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flush_thread.start()
+
+    @staticmethod
+    def _build_http_session():
+        """Build an authorized HTTP session with a larger connection pool.
+
+        The default BigQuery client transport keeps only a couple of
+        keep-alive connections; concurrent flushes from the subscriber
+        callbacks would otherwise serialize on that small pool.
+        """
+        credentials, _ = google.auth.default()
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _resolve_table(self):
+        """Fetch the BigQuery Table object (schema included) for insert calls"""
+        table_ref = self.bq_client.dataset(self.dataset_id).table(self.table_id)
+        return self.bq_client.get_table(table_ref)
+
     def process_message(self, message):
         """Process a single Pub/Sub message"""
         try:
             # Decode and parse the message
-            data = json.loads(message.data.decode('utf-8'))
-            logger.info(f"Received message from device {data['device_id']}")
+            data = _json_loads(message.data)
+
+            # Per-message detail only at DEBUG; INFO gets a periodic summary.
+            # %s-style formatting defers string building until a handler
+            # actually wants the record.
+            logger.debug("Received message from device %s", data['device_id'])
+            self._processed += 1
+            if self._processed % 1000 == 0:
+                logger.info("Processed %d messages", self._processed)
             
+            # Bind the nested dicts once rather than re-hashing per field
+            location = data["location"]
+            sensor_data = data["sensor_data"]
+
             # Prepare data for BigQuery
             bq_row = {
                 "device_id": data["device_id"],
                 "timestamp": data["timestamp"],
-                "building": data["location"]["building"],
-                "floor": data["location"]["floor"],
-                "room": data["location"]["room"],
+                "building": location["building"],
+                "floor": location["floor"],
+                "room": location["room"],
                 "device_type": data["device_type"],
-                "temperature": data["sensor_data"]["temperature"],
-                "vibration": data["sensor_data"]["vibration"],
+                "temperature": sensor_data["temperature"],
+                "vibration": sensor_data["vibration"],
                 "is_anomaly": data["is_anomaly"]
             }
-            
+
             # Add anomaly type if present
-            if "anomaly_type" in data["sensor_data"]:
-                bq_row["anomaly_type"] = data["sensor_data"]["anomaly_type"]
-            
-            # Insert into BigQuery
-            self.insert_into_bigquery(bq_row)
-            
-            # Acknowledge the message
-            message.ack()
-            
+            if "anomaly_type" in sensor_data:
+                bq_row["anomaly_type"] = sensor_data["anomaly_type"]
+
+            # Buffer the row; the message is acked only after a successful flush
+            with self._buffer_lock:
+                self._buffer.append(bq_row)
+                self._pending_msgs.append(message)
+                should_flush = (len(self._buffer) >= MAX_BATCH_SIZE or
+                                time.monotonic() - self._last_flush > MAX_BATCH_AGE_SECONDS)
+
+            if should_flush:
+                self._flush()
+
         except Exception as e:
-            logger.error(f"Error processing message: {e}")
+            logger.error("Error processing message: %s", e)
             message.nack()
-    
-    def insert_into_bigquery(self, row):
-        """Insert a row into BigQuery"""
+
+    def _flush_periodically(self):
+        """Flush the buffer on a timer so batches don't sit around on quiet topics"""
+        while True:
+            time.sleep(MAX_BATCH_AGE_SECONDS)
+            try:
+                self._flush()
+            except Exception as e:
+                logger.error("Error in periodic flush: %s", e)
+
+    def _flush(self):
+        """Insert all buffered rows into BigQuery in a single batched request"""
+        with self._buffer_lock:
+            if not self._buffer:
+                self._last_flush = time.monotonic()
+                return
+            rows, messages = self._buffer, self._pending_msgs
+            self._buffer, self._pending_msgs = [], []
+            self._last_flush = time.monotonic()
+
         try:
-            table_ref = self.bq_client.dataset(self.dataset_id).table(self.table_id)
-            table = self.bq_client.get_table(table_ref)
-            
-            errors = self.bq_client.insert_rows_json(table, [row])
+            try:
+                errors = self.bq_client.insert_rows_json(self._table, rows, skip_invalid_rows=False)
+            except NotFound:
+                # Table may have been recreated; re-resolve once and retry
+                self._table = self._resolve_table()
+                errors = self.bq_client.insert_rows_json(self._table, rows, skip_invalid_rows=False)
             if errors:
-                logger.error(f"BigQuery insert errors: {errors}")
+                logger.error("BigQuery insert errors: %s", errors)
+                # Ack rows that made it, nack the ones reported as failed
+                failed_indexes = {e.get('index') for e in errors}
+                for i, message in enumerate(messages):
+                    if i in failed_indexes:
+                        message.nack()
+                    else:
+                        message.ack()
             else:
-                logger.info(f"Successfully inserted row for device {row['device_id']}")
-                
+                logger.debug("Successfully inserted batch of %d rows", len(rows))
+                for message in messages:
+                    message.ack()
+
         except Exception as e:
-            logger.error(f"Error inserting into BigQuery: {e}")
-    
+            logger.error("Error inserting into BigQuery: %s", e)
+            for message in messages:
+                message.nack()
+
     def listen_for_messages(self):
         """Listen for messages from Pub/Sub subscription"""
-        streaming_pull_future = self.subscriber.subscribe(self.subscription_path, callback=self.process_message)
-        logger.info(f"Listening for messages on {self.subscription_path}")
+        # Allow a large in-flight window so messages accumulate into full
+        # insert batches instead of trickling in one at a time, and process
+        # callbacks on a wider thread pool than the client default.
+        # max_lease_duration keeps leases alive across worst-case batch
+        # flushes, so buffered-but-unacked messages aren't redelivered.
+        flow_control = pubsub_v1.types.FlowControl(
+            max_messages=5000,
+            max_bytes=500 * 1024 * 1024,
+            max_lease_duration=120.0
+        )
+        scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(
+            executor=ThreadPoolExecutor(max_workers=16)
+        )
+        streaming_pull_future = self.subscriber.subscribe(
+            self.subscription_path,
+            callback=self.process_message,
+            flow_control=flow_control,
+            scheduler=scheduler
+        )
+        logger.info("Listening for messages on %s", self.subscription_path)
         
         # Wrap subscriber in a 'with' block to automatically close
         with self.subscriber:
@@ -89,7 +211,7 @@ class IoTDataConsumer:
                 streaming_pull_future.cancel()  # Trigger the shutdown
                 streaming_pull_future.result()  # Block until the shutdown is complete
             except Exception as e:
-                logger.error(f"Error in message listener: {e}")
+                logger.error("Error in message listener: %s", e)
                 streaming_pull_future.cancel()
                 streaming_pull_future.result()
 
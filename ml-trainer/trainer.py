@@ -17,10 +17,51 @@ from google.cloud import bigquery
 from datetime import datetime, timedelta
 import os
 
+# The Storage Read API streams query results as Arrow record batches
+# instead of paging JSON rows; fall back to plain fetch without it
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 50 trees score within noise of 100 on this feature set (check the
+# ROC-AUC in the saved metrics when tuning); halving trees halves
+# per-request CPU at serve time
+DEFAULT_N_ESTIMATORS = int(os.getenv("N_ESTIMATORS", "50"))
+
+def _segment_rolling_mean(values, segment_starts, window):
+    """Rolling mean (min_periods=1) over contiguous per-device segments.
+
+    One cumulative-sum pass over the whole column replaces pandas'
+    groupby.rolling, which dispatches into Python for every device group.
+    """
+    n = len(values)
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(n)
+    counts = np.diff(np.concatenate((segment_starts, [n])))
+    # Position of each row within its device segment
+    pos = idx - np.repeat(segment_starts, counts)
+    win = np.minimum(pos + 1, window)
+    return (csum[idx + 1] - csum[idx + 1 - win]) / win
+
+def _segment_zscore(values, segment_starts):
+    """Per-device z-scores computed with reduceat instead of groupby.apply"""
+    n = len(values)
+    counts = np.diff(np.concatenate((segment_starts, [n])))
+    sums = np.add.reduceat(values, segment_starts)
+    means = sums / counts
+    sq_sums = np.add.reduceat(values * values, segment_starts)
+    # Sample std (ddof=1) to match pandas Series.std; single-row devices
+    # get NaN, which the caller's fillna(0) handles
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.where(counts > 1, (sq_sums - counts * means * means) / (counts - 1), np.nan)
+        std = np.sqrt(np.maximum(var, 0))
+        return (values - np.repeat(means, counts)) / np.repeat(std, counts)
+
 class AnomalyDetectionTrainer:
     def __init__(self, project_id):
         self.project_id = project_id
@@ -28,6 +69,7 @@ class AnomalyDetectionTrainer:
         self.dataset_id = "iot_data"
         self.table_id = "sensor_readings"
         self.model_dir = "./ml-models"
+        self.bqstorage_client = bigquery_storage.BigQueryReadClient() if bigquery_storage else None
         
         # Create model directory if it doesn't exist
         os.makedirs(self.model_dir, exist_ok=True)
@@ -52,8 +94,14 @@ class AnomalyDetectionTrainer:
             ORDER BY timestamp
             """
             
-            # Execute query
-            df = self.bq_client.query(query).to_dataframe()
+            # Execute query; pull results over the Storage Read API as
+            # Arrow when available (columnar transport, zero-copy into
+            # pandas) instead of the row-at-a-time JSON path
+            job = self.bq_client.query(query)
+            if self.bqstorage_client is not None:
+                df = job.to_arrow(bqstorage_client=self.bqstorage_client).to_pandas()
+            else:
+                df = job.to_dataframe()
             logger.info(f"Fetched {len(df)} records for training")
             
             return df
@@ -73,16 +121,23 @@ class AnomalyDetectionTrainer:
             df['day_of_week'] = df['timestamp'].dt.dayofweek
             
             # Calculate statistical features
-            # Group by device to calculate moving averages and z-scores
+            # Sorting by device gives contiguous segments, so the moving
+            # averages and z-scores become single vectorized passes over
+            # the whole column instead of a Python loop per device group
             df_sorted = df.sort_values(['device_id', 'timestamp'])
-            
+            codes = pd.factorize(df_sorted['device_id'])[0]
+            segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+
+            temperature = df_sorted['temperature'].to_numpy(dtype=np.float64)
+            vibration = df_sorted['vibration'].to_numpy(dtype=np.float64)
+
             # Moving averages (5-point window)
-            df_sorted['temp_ma'] = df_sorted.groupby('device_id')['temperature'].rolling(window=5, min_periods=1).mean().reset_index(0, drop=True)
-            df_sorted['vibration_ma'] = df_sorted.groupby('device_id')['vibration'].rolling(window=5, min_periods=1).mean().reset_index(0, drop=True)
-            
+            df_sorted['temp_ma'] = _segment_rolling_mean(temperature, segment_starts, window=5)
+            df_sorted['vibration_ma'] = _segment_rolling_mean(vibration, segment_starts, window=5)
+
             # Z-scores
-            df_sorted['temp_zscore'] = df_sorted.groupby('device_id', group_keys=False)['temperature'].apply(lambda x: (x - x.mean()) / x.std()).reset_index(0, drop=True)
-            df_sorted['vibration_zscore'] = df_sorted.groupby('device_id', group_keys=False)['vibration'].apply(lambda x: (x - x.mean()) / x.std()).reset_index(0, drop=True)
+            df_sorted['temp_zscore'] = _segment_zscore(temperature, segment_starts)
+            df_sorted['vibration_zscore'] = _segment_zscore(vibration, segment_starts)
             
             # Select features for training
             feature_columns = ['temperature', 'vibration', 'hour', 'day_of_week', 'temp_ma', 'vibration_ma', 'temp_zscore', 'vibration_zscore']
@@ -94,7 +149,7 @@ class AnomalyDetectionTrainer:
             logger.error(f"Error preparing features: {e}")
             return None, None
     
-    def train_isolation_forest(self, X, y_true, model_name):
+    def train_isolation_forest(self, X, y_true, model_name, n_estimators=None):
         """Train an Isolation Forest model with evaluation"""
         try:
             # Split data for evaluation
@@ -102,16 +157,19 @@ class AnomalyDetectionTrainer:
                 X, y_true, test_size=0.2, random_state=42, stratify=y_true
             )
             
-            # Standardize features
+            # Standardize features; fit on float32 so the serving side can
+            # score float32 buffers without an implicit upcast
             scaler = StandardScaler()
-            X_train_scaled = scaler.fit_transform(X_train)
-            X_test_scaled = scaler.transform(X_test)
+            X_train_scaled = scaler.fit_transform(X_train.astype(np.float32))
+            X_test_scaled = scaler.transform(X_test.astype(np.float32))
             
-            # Train Isolation Forest
+            # Train Isolation Forest; max_samples=256 caps tree depth at
+            # ~8 regardless of how much history the fetch returned
             model = IsolationForest(
                 contamination=0.1,  # Expected proportion of anomalies
                 random_state=42,
-                n_estimators=100
+                n_estimators=n_estimators or DEFAULT_N_ESTIMATORS,
+                max_samples=256
             )
             model.fit(X_train_scaled)
             
@@ -183,17 +241,21 @@ class AnomalyDetectionTrainer:
                 logger.error("Failed to prepare features")
                 return
             
-            # Train temperature anomaly detection model
+            # Train the combined model on all 8 features; this carries the
+            # overall anomaly decision at serve time, so one forest walk
+            # replaces two full per-channel ensembles
+            y = df_processed['is_anomaly'].fillna(0)
+            self.train_isolation_forest(X, y, "combined")
+
+            # Train lighter per-channel models kept only for channel
+            # attribution (which sensor tripped the alert)
             temp_features = ['temperature', 'hour', 'day_of_week', 'temp_ma', 'temp_zscore']
             X_temp = df_processed[temp_features].fillna(0)
-            y_temp = df_processed['is_anomaly'].fillna(0)
-            self.train_isolation_forest(X_temp, y_temp, "temperature")
-            
-            # Train vibration anomaly detection model
+            self.train_isolation_forest(X_temp, y, "temperature", n_estimators=20)
+
             vibration_features = ['vibration', 'hour', 'day_of_week', 'vibration_ma', 'vibration_zscore']
             X_vibration = df_processed[vibration_features].fillna(0)
-            y_vibration = df_processed['is_anomaly'].fillna(0)
-            self.train_isolation_forest(X_vibration, y_vibration, "vibration")
+            self.train_isolation_forest(X_vibration, y, "vibration", n_estimators=20)
             
             logger.info("All models trained successfully")
             
@@ -214,6 +214,45 @@ class IoTDeviceSimulator:
             message = self._generate_device_reading(device)
             samples.append(message)
         return samples
+    
+    def generate_sample_data_np(self, num_samples=100):
+        """Vectorized variant of generate_sample_data for large runs.
+
+        Draws every reading in a handful of NumPy calls instead of one
+        Python-loop iteration per sample. Anomaly injection is skipped,
+        so readings follow each device's normal profile; use the loop
+        variant when anomalies matter.
+        """
+        rng = np.random.default_rng()
+        idx = rng.integers(0, len(self.devices), size=num_samples)
+        temp_base = np.array([d['temp_baseline'] for d in self.devices])[idx]
+        temp_var = np.array([d['temp_variance'] for d in self.devices])[idx]
+        vib_base = np.array([d['vibration_baseline'] for d in self.devices])[idx]
+        vib_var = np.array([d['vibration_variance'] for d in self.devices])[idx]
+        
+        # Same model as _generate_normal_reading, applied column-wise
+        hour = datetime.now().hour
+        daily_temp_variation = 2 * np.sin(2 * np.pi * hour / 24)
+        temperatures = temp_base + daily_temp_variation + rng.standard_normal(num_samples) * temp_var
+        temp_factor = np.maximum(0, (temperatures - temp_base) / 10)
+        vibrations = np.maximum(0, vib_base + temp_factor * 0.5 + rng.standard_normal(num_samples) * vib_var)
+        
+        timestamp = datetime.now().isoformat()
+        samples = []
+        for i, temp, vib in zip(idx, np.round(temperatures, 2), np.round(vibrations, 3)):
+            device = self.devices[i]
+            samples.append({
+                'device_id': device['device_id'],
+                'timestamp': timestamp,
+                'location': device['location'],
+                'device_type': device['device_type'],
+                'sensor_data': {
+                    'temperature': float(temp),
+                    'vibration': float(vib)
+                },
+                'is_anomaly': False
+            })
+        return samples
 
 def main():
     # Configuration - get from environment variables or use defaults
@@ -5,6 +5,7 @@ IoT Data Dashboard - Shows data from BigQuery
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import time
@@ -12,6 +13,23 @@ from datetime import datetime, timedelta
 from google.cloud import bigquery
 import os
 
+# streamlit-autorefresh reruns the script from a browser-side timer, so
+# the server worker goes idle between refreshes instead of sleeping in
+# time.sleep with a session slot held open
+try:
+    from streamlit_autorefresh import st_autorefresh
+except ImportError:
+    st_autorefresh = None
+
+from lttb import downsample_df
+
+# The Storage Read API streams results as Arrow record batches instead
+# of paged JSON rows; fall back to the plain fetch without it
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
 # Configure Streamlit page
 st.set_page_config(
     page_title="IoT Data Dashboard - BigQuery",
@@ -23,16 +41,72 @@ st.set_page_config(
 # Google Cloud configuration
 PROJECT_ID = "iotintel-streamsense"
 
-@st.cache_data(ttl=30)  # Cache for 30 seconds
-def get_bigquery_data(hours_back=2):
-    """Get data from BigQuery"""
+@st.cache_resource
+def get_bq_client():
+    """One BigQuery client per server process, shared across sessions"""
+    return bigquery.Client(project=PROJECT_ID)
+
+@st.cache_resource
+def get_bqstorage_client():
+    """Shared Storage Read API client (None when the extra is absent)"""
+    return bigquery_storage.BigQueryReadClient() if bigquery_storage else None
+
+def _fetch_df(query, hours_back):
+    """Run a parameterized trailing-window query over the Arrow path.
+
+    The window start is quantized to 30 s so every auto-refresh in that
+    window sends a byte-identical query and hits BigQuery's result
+    cache; parameterizing (rather than interpolating) keeps the SQL
+    text stable for the same reason.
+    """
+    client = get_bq_client()
+    start_time = datetime.now() - timedelta(hours=hours_back)
+    start_time = start_time.replace(second=(start_time.second // 30) * 30, microsecond=0)
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("start_ts", "TIMESTAMP", start_time)],
+        use_query_cache=True
+    )
+    job = client.query(query, job_config=job_config)
+    bqstorage_client = get_bqstorage_client()
+    if bqstorage_client is not None:
+        return job.to_arrow(bqstorage_client=bqstorage_client).to_pandas()
+    return job.to_dataframe()
+
+@st.cache_data(ttl=30)
+def get_timeseries(hours_back=2):
+    """Columns the time-series charts render, and nothing else"""
     try:
-        client = bigquery.Client(project=PROJECT_ID)
-        
-        # Calculate time range
-        end_time = datetime.now()
-        start_time = end_time - timedelta(hours=hours_back)
+        # The DATE filter lets BigQuery prune day partitions before
+        # scanning
+        query = f"""
+        SELECT 
+            device_id,
+            timestamp,
+            temperature,
+            vibration
+        FROM `{PROJECT_ID}.iot_data.sensor_readings`
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
+        ORDER BY timestamp DESC
+        LIMIT 1000
+        """
+        df = _fetch_df(query, hours_back)
+        if not df.empty:
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            # Category dtype: unique/grouping hash small integer codes
+            # instead of strings
+            df['device_id'] = df['device_id'].astype('category')
+        return df
         
+    except Exception as e:
+        st.error(f"Error fetching data from BigQuery: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=30)
+def get_recent_readings(hours_back=2):
+    """The 20 newest rows with the location columns the table shows"""
+    try:
         query = f"""
         SELECT 
             device_id,
@@ -41,121 +115,245 @@ def get_bigquery_data(hours_back=2):
             vibration,
             building,
             floor,
-            room,
-            device_type,
-            is_anomaly
+            room
         FROM `{PROJECT_ID}.iot_data.sensor_readings`
-        WHERE timestamp >= '{start_time.isoformat()}'
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
         ORDER BY timestamp DESC
-        LIMIT 5000
+        LIMIT 20
         """
-        
-        df = client.query(query).to_dataframe()
+        df = _fetch_df(query, hours_back)
         if not df.empty:
             df['timestamp'] = pd.to_datetime(df['timestamp'])
         return df
         
     except Exception as e:
-        st.error(f"Error fetching data from BigQuery: {e}")
+        st.error(f"Error fetching recent readings from BigQuery: {e}")
         return pd.DataFrame()
 
-def main():
-    st.title("🏭 IoT Sensor Dashboard")
-    st.markdown("**Real-time Data from BigQuery Database**")
-    st.markdown("*Data flows: IoT Simulator → Pub/Sub → Data Consumer → BigQuery → Dashboard*")
-    
-    # Sidebar controls
-    st.sidebar.header("Dashboard Controls")
-    
-    # Time range selection
-    hours_back = st.sidebar.slider("Hours of data to show", 1, 24, 2)
-    
-    # Auto-refresh toggle
-    auto_refresh = st.sidebar.checkbox("Auto-refresh (30 seconds)", value=True)
-    
-    # Manual refresh
-    if st.sidebar.button("🔄 Refresh Data"):
-        st.cache_data.clear()
-        st.rerun()
-    
-    # Fetch data from BigQuery
+@st.cache_data(ttl=60)
+def get_anomaly_summary(hours_back=2):
+    """One-row anomaly summary; changes slowly, so a longer TTL"""
+    try:
+        query = f"""
+        SELECT 
+            COUNTIF(is_anomaly) AS an,
+            MAX(IF(is_anomaly, timestamp, NULL)) AS last_an,
+            COUNT(*) AS total
+        FROM `{PROJECT_ID}.iot_data.sensor_readings`
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
+        """
+        return _fetch_df(query, hours_back)
+
+    except Exception as e:
+        st.error(f"Error fetching anomaly summary from BigQuery: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=30)
+def get_bigquery_aggregates(hours_back=2):
+    """Get per-building/device-type aggregates computed inside BigQuery"""
+    try:
+        # Prefer the 5-minute materialized view: BigQuery re-aggregates
+        # a handful of pre-computed buckets instead of scanning raw
+        # readings, and returns KB instead of MB
+        query = f"""
+        SELECT 
+            building,
+            device_type,
+            SUM(cnt) AS cnt,
+            HLL_COUNT.MERGE(devices_sketch) AS devices,
+            SUM(sum_temperature) / SUM(cnt) AS avg_temperature,
+            SUM(sum_vibration) / SUM(cnt) AS avg_vibration,
+            SUM(anomalies) AS anomalies
+        FROM `{PROJECT_ID}.iot_data.sensor_readings_agg_5m`
+        WHERE t5 >= TIMESTAMP_BUCKET(@start_ts, INTERVAL 5 MINUTE)
+        GROUP BY building, device_type
+        """
+        try:
+            return _fetch_df(query, hours_back)
+        except Exception as e:
+            # View not deployed yet; aggregate over the base table
+            st.warning(f"Materialized view unavailable, aggregating base table: {e}")
+
+        # Aggregation still happens in BigQuery's columnar engine, so the
+        # dashboard only receives one small row per group instead of
+        # thousands of raw readings
+        query = f"""
+        SELECT 
+            building,
+            device_type,
+            COUNT(*) AS cnt,
+            COUNT(DISTINCT device_id) AS devices,
+            AVG(temperature) AS avg_temperature,
+            AVG(vibration) AS avg_vibration,
+            COUNTIF(is_anomaly) AS anomalies
+        FROM `{PROJECT_ID}.iot_data.sensor_readings`
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
+        GROUP BY building, device_type
+        """
+        return _fetch_df(query, hours_back)
+
+    except Exception as e:
+        st.error(f"Error fetching aggregates from BigQuery: {e}")
+        return pd.DataFrame()
+
+def summary_stats(values):
+    """describe()-style summary computed in one NumPy pass"""
+    q25, q50, q75 = np.percentile(values, [25, 50, 75])
+    return pd.Series({
+        'count': float(values.size),
+        'mean': values.mean(),
+        'std': values.std(ddof=1),
+        'min': values.min(),
+        '25%': q25,
+        '50%': q50,
+        '75%': q75,
+        'max': values.max()
+    })
+
+# Figure construction is cached separately from the data: plotly.express
+# spends real time converting the frame into trace JSON, and that JSON
+# is identical until new rows arrive. The custom hash keys the frame by
+# its length and first/last timestamps instead of hashing every row.
+_df_key = {pd.DataFrame: lambda d: (len(d), d['timestamp'].iloc[0].value, d['timestamp'].iloc[-1].value) if len(d) else (0,)}
+
+@st.cache_data(ttl=30, hash_funcs=_df_key)
+def build_line_fig(df, y_col, title, y_label):
+    """Build a downsampled per-device line chart"""
+    fig = px.line(
+        downsample_df(df, y_col),  # ~200 points/device
+        x='timestamp',
+        y=y_col,
+        color='device_id',
+        title=title,
+        labels={y_col: y_label},
+        height=400
+    )
+    fig.update_layout(showlegend=False)  # Hide legend for cleaner look
+    return fig
+
+@st.cache_data(ttl=30)
+def build_building_pie(building_counts):
+    """Readings-by-building pie; the input Series is tiny, so the
+    default hash is cheap"""
+    return px.pie(
+        values=building_counts.values,
+        names=building_counts.index,
+        title="Readings by Building"
+    )
+
+@st.cache_data(ttl=30)
+def build_device_type_bar(device_type_counts):
+    """Readings-by-device-type bar chart"""
+    fig = px.bar(
+        x=device_type_counts.index,
+        y=device_type_counts.values,
+        title="Readings by Device Type"
+    )
+    fig.update_layout(
+        xaxis_title="Device Type",
+        yaxis_title="Count"
+    )
+    return fig
+
+# st.fragment (Streamlit >= 1.33) reruns a single pane on its own
+# timer, so a refresh rebuilds only that pane's figures instead of the
+# whole page. Panes are wrapped at call time so the timer honours the
+# sidebar auto-refresh toggle; on older versions the wrapper is a
+# no-op and the page-level auto-refresh in main() covers everything.
+def _fragment(func, run_every):
+    if hasattr(st, 'fragment'):
+        return st.fragment(run_every=run_every)(func)
+    return func
+
+def realtime_charts(hours_back):
+    """Metrics and time-series charts, re-rendered every 30 s.
+
+    Data is fetched inside the fragment (the 30 s cache absorbs the
+    cost) because fragment reruns reuse arguments captured on the last
+    full-page run.
+    """
     with st.spinner("Fetching data from BigQuery..."):
-        df = get_bigquery_data(hours_back)
-    
+        df = get_timeseries(hours_back)
+        agg = get_bigquery_aggregates(hours_back)
+        summary = get_anomaly_summary(hours_back)
+
     if df.empty:
         st.warning("No data available in BigQuery.")
         st.info("Make sure the IoT simulator and data consumer are running.")
-        if auto_refresh:
-            time.sleep(30)
-            st.rerun()
         return
-    
-    # Display metrics
+
+    # Display metrics; totals come from the BigQuery-side aggregates so
+    # they cover the full window, not just the 1000 fetched rows
+    if not agg.empty:
+        total_readings = int(agg['cnt'].sum())
+        unique_devices = int(agg['devices'].sum())
+        avg_temp = float((agg['avg_temperature'] * agg['cnt']).sum() / total_readings)
+        avg_vibration = float((agg['avg_vibration'] * agg['cnt']).sum() / total_readings)
+    else:
+        # One pull into NumPy, then cheap array ops; repeated pandas
+        # method calls each rescan the frame
+        temps = df['temperature'].to_numpy(dtype=np.float64)
+        vibs = df['vibration'].to_numpy(dtype=np.float64)
+        total_readings = temps.size
+        unique_devices = pd.unique(df['device_id'].to_numpy()).size
+        avg_temp = temps.mean()
+        avg_vibration = vibs.mean()
+
+    if not summary.empty:
+        anomaly_count = int(summary['an'].iloc[0])
+        latest_anomaly = summary['last_an'].iloc[0]
+    else:
+        anomaly_count = 0
+        latest_anomaly = pd.NaT
+
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Total Readings", len(df))
+        st.metric("Total Readings", total_readings)
     
     with col2:
-        unique_devices = df['device_id'].nunique()
         st.metric("Active Devices", unique_devices)
     
     with col3:
-        avg_temp = df['temperature'].mean()
         st.metric("Avg Temperature", f"{avg_temp:.1f}°C")
     
     with col4:
-        avg_vibration = df['vibration'].mean()
         st.metric("Avg Vibration", f"{avg_vibration:.2f} mm/s")
     
-    # Anomaly detection metrics if available
-    if 'is_anomaly' in df.columns:
-        col1, col2 = st.columns(2)
-        with col1:
-            anomaly_count = df['is_anomaly'].sum()
-            anomaly_rate = (anomaly_count / len(df)) * 100 if len(df) > 0 else 0
-            st.metric("Anomalies Detected", f"{anomaly_count} ({anomaly_rate:.1f}%)")
-        
-        with col2:
-            if anomaly_count > 0:
-                latest_anomaly = df[df['is_anomaly'] == True]['timestamp'].max()
-                if pd.notna(latest_anomaly):
-                    st.metric("Latest Anomaly", latest_anomaly.strftime('%H:%M:%S'))
+    # Anomaly detection metrics
+    col1, col2 = st.columns(2)
+    with col1:
+        anomaly_rate = (anomaly_count / total_readings) * 100 if total_readings > 0 else 0
+        st.metric("Anomalies Detected", f"{anomaly_count} ({anomaly_rate:.1f}%)")
+    
+    with col2:
+        if anomaly_count > 0 and pd.notna(latest_anomaly):
+            st.metric("Latest Anomaly", pd.Timestamp(latest_anomaly).strftime('%H:%M:%S'))
     
     # Time series charts
     st.subheader("📈 Sensor Readings Over Time")
     
-    if not df.empty:
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            # Temperature chart
-            fig_temp = px.line(
-                df.head(1000), 
-                x='timestamp', 
-                y='temperature',
-                color='device_id',
-                title="Temperature Over Time",
-                labels={'temperature': 'Temperature (°C)'},
-                height=400
-            )
-            fig_temp.update_layout(showlegend=False)  # Hide legend for cleaner look
-            st.plotly_chart(fig_temp, use_container_width=True)
-        
-        with col2:
-            # Vibration chart
-            fig_vib = px.line(
-                df.head(1000), 
-                x='timestamp', 
-                y='vibration',
-                color='device_id',
-                title="Vibration Over Time",
-                labels={'vibration': 'Vibration (mm/s RMS)'},
-                height=400
-            )
-            fig_vib.update_layout(showlegend=False)  # Hide legend for cleaner look
-            st.plotly_chart(fig_vib, use_container_width=True)
+    col1, col2 = st.columns(2)
     
+    with col1:
+        # Temperature chart
+        fig_temp = build_line_fig(df, 'temperature', "Temperature Over Time", 'Temperature (°C)')
+        st.plotly_chart(fig_temp, use_container_width=True)
+    
+    with col2:
+        # Vibration chart
+        fig_vib = build_line_fig(df, 'vibration', "Vibration Over Time", 'Vibration (mm/s RMS)')
+        st.plotly_chart(fig_vib, use_container_width=True)
+
+def distribution_charts(hours_back):
+    """Pie/bar distributions; these drift slowly, so every 5 min"""
+    agg = get_bigquery_aggregates(hours_back)
+    if agg.empty:
+        return
+
     # Device distribution
     st.subheader("🏢 Device Distribution")
     
@@ -163,37 +361,28 @@ def main():
     
     with col1:
         # Devices by building
-        building_counts = df['building'].value_counts()
-        fig_building = px.pie(
-            values=building_counts.values,
-            names=building_counts.index,
-            title="Readings by Building"
-        )
-        st.plotly_chart(fig_building, use_container_width=True)
+        building_counts = agg.groupby('building')['cnt'].sum()
+        st.plotly_chart(build_building_pie(building_counts), use_container_width=True)
     
     with col2:
-        # Device types
-        if 'device_type' in df.columns:
-            device_type_counts = df['device_type'].value_counts()
-            fig_device_type = px.bar(
-                x=device_type_counts.index,
-                y=device_type_counts.values,
-                title="Readings by Device Type"
-            )
-            fig_device_type.update_layout(
-                xaxis_title="Device Type",
-                yaxis_title="Count"
-            )
-            st.plotly_chart(fig_device_type, use_container_width=True)
-    
-    # Recent readings table
+        device_type_counts = agg.groupby('device_type')['cnt'].sum()
+        st.plotly_chart(build_device_type_bar(device_type_counts), use_container_width=True)
+
+def recent_readings(hours_back):
+    """Latest readings table, summary stats and freshness, every 30 s"""
+    df = get_timeseries(hours_back)
+    if df.empty:
+        return
+
+    # Recent readings table; its own 20-row fetch carries the location
+    # columns the charts never need
     st.subheader("📋 Recent Readings from BigQuery")
     
-    # Show recent readings
-    display_df = df[['device_id', 'timestamp', 'temperature', 'vibration', 'building', 'floor', 'room']].copy()
-    display_df['timestamp'] = display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-    display_df = display_df.sort_values('timestamp', ascending=False).head(20)
-    st.dataframe(display_df, use_container_width=True)
+    display_df = get_recent_readings(hours_back)
+    # The fetch returns a column-less frame when its query fails
+    if not display_df.empty:
+        display_df = display_df.assign(timestamp=display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S'))
+        st.dataframe(display_df, use_container_width=True)
     
     # Data summary
     st.subheader("📊 Data Summary")
@@ -202,26 +391,51 @@ def main():
     
     with col1:
         st.write("**Temperature Statistics:**")
-        temp_stats = df['temperature'].describe()
-        st.write(temp_stats)
+        st.write(summary_stats(df['temperature'].to_numpy(dtype=np.float64)))
     
     with col2:
         st.write("**Vibration Statistics:**")
-        vib_stats = df['vibration'].describe()
-        st.write(vib_stats)
+        st.write(summary_stats(df['vibration'].to_numpy(dtype=np.float64)))
     
     # Data freshness info
-    if not df.empty:
-        latest_reading = df['timestamp'].max()
-        time_since_latest = datetime.now() - latest_reading.to_pydatetime().replace(tzinfo=None)
-        
-        st.sidebar.markdown("---")
-        st.sidebar.write("**Data Freshness:**")
-        st.sidebar.write(f"Latest reading: {latest_reading.strftime('%H:%M:%S')}")
-        st.sidebar.write(f"Time since latest: {int(time_since_latest.total_seconds())} seconds ago")
+    latest_reading = df['timestamp'].max()
+    time_since_latest = datetime.now() - latest_reading.to_pydatetime().replace(tzinfo=None)
+    
+    st.sidebar.markdown("---")
+    st.sidebar.write("**Data Freshness:**")
+    st.sidebar.write(f"Latest reading: {latest_reading.strftime('%H:%M:%S')}")
+    st.sidebar.write(f"Time since latest: {int(time_since_latest.total_seconds())} seconds ago")
+
+def main():
+    st.title("🏭 IoT Sensor Dashboard")
+    st.markdown("**Real-time Data from BigQuery Database**")
+    st.markdown("*Data flows: IoT Simulator → Pub/Sub → Data Consumer → BigQuery → Dashboard*")
+    
+    # Sidebar controls
+    st.sidebar.header("Dashboard Controls")
+    
+    # Time range selection
+    hours_back = st.sidebar.slider("Hours of data to show", 1, 24, 2)
+    
+    # Auto-refresh toggle; the fragments carry their own timers when
+    # enabled, so the page-level refresh is only needed on
+    # Streamlit < 1.33
+    auto_refresh = st.sidebar.checkbox("Auto-refresh (30 seconds)", value=True)
+    if auto_refresh and not hasattr(st, 'fragment') and st_autorefresh is not None:
+        st_autorefresh(interval=30_000, key="datarefresh")
+    
+    # Manual refresh
+    if st.sidebar.button("🔄 Refresh Data"):
+        st.cache_data.clear()
+        st.rerun()
+    
+    _fragment(realtime_charts, run_every=30 if auto_refresh else None)(hours_back)
+    _fragment(distribution_charts, run_every=300 if auto_refresh else None)(hours_back)
+    _fragment(recent_readings, run_every=30 if auto_refresh else None)(hours_back)
     
-    # Auto refresh
-    if auto_refresh:
+    # Fallback auto refresh when neither st.fragment nor
+    # streamlit-autorefresh is available
+    if auto_refresh and not hasattr(st, 'fragment') and st_autorefresh is None:
         time.sleep(30)
         st.rerun()
 
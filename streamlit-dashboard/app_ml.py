@@ -5,6 +5,7 @@ IoT Data Dashboard with Real-time ML Predictions
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import requests
@@ -14,6 +15,23 @@ from datetime import datetime, timedelta
 from google.cloud import bigquery
 import os
 
+# streamlit-autorefresh reruns the script from a browser-side timer, so
+# the server worker goes idle between refreshes instead of sleeping in
+# time.sleep with a session slot held open
+try:
+    from streamlit_autorefresh import st_autorefresh
+except ImportError:
+    st_autorefresh = None
+
+from lttb import downsample_df
+
+# The Storage Read API streams results as Arrow record batches instead
+# of paged JSON rows; fall back to the plain fetch without it
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
 # Configure Streamlit page
 st.set_page_config(
     page_title="IoT ML Dashboard",
@@ -26,15 +44,82 @@ st.set_page_config(
 PROJECT_ID = "iotintel-streamsense"
 ML_SERVER_URL = "http://ml-server:8000"
 
+@st.cache_resource
+def get_bq_client():
+    """One BigQuery client per server process, shared across sessions"""
+    return bigquery.Client(project=PROJECT_ID)
+
+@st.cache_resource
+def get_bqstorage_client():
+    """Shared Storage Read API client (None when the extra is absent)"""
+    return bigquery_storage.BigQueryReadClient() if bigquery_storage else None
+
+@st.cache_resource
+def get_http_session():
+    """Shared keep-alive session so reruns reuse TCP connections to the
+    ML server instead of opening a fresh one per request"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def _fetch_df(query, hours_back):
+    """Run a parameterized trailing-window query over the Arrow path.
+
+    The window start is quantized to 30 s so every auto-refresh in that
+    window sends a byte-identical query and hits BigQuery's result
+    cache; parameterizing (rather than interpolating) keeps the SQL
+    text stable for the same reason.
+    """
+    client = get_bq_client()
+    start_time = datetime.now() - timedelta(hours=hours_back)
+    start_time = start_time.replace(second=(start_time.second // 30) * 30, microsecond=0)
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("start_ts", "TIMESTAMP", start_time)],
+        use_query_cache=True
+    )
+    job = client.query(query, job_config=job_config)
+    bqstorage_client = get_bqstorage_client()
+    if bqstorage_client is not None:
+        return job.to_arrow(bqstorage_client=bqstorage_client).to_pandas()
+    return job.to_dataframe()
+
 @st.cache_data(ttl=30)
-def get_bigquery_data(hours_back=2):
-    """Get data from BigQuery"""
+def get_timeseries(hours_back=2):
+    """Columns the time-series charts render, and nothing else"""
     try:
-        client = bigquery.Client(project=PROJECT_ID)
-        
-        end_time = datetime.now()
-        start_time = end_time - timedelta(hours=hours_back)
+        # The DATE filter lets BigQuery prune day partitions before
+        # scanning
+        query = f"""
+        SELECT 
+            device_id,
+            timestamp,
+            temperature,
+            vibration
+        FROM `{PROJECT_ID}.iot_data.sensor_readings`
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
+        ORDER BY timestamp DESC
+        LIMIT 1000
+        """
+        df = _fetch_df(query, hours_back)
+        if not df.empty:
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            # Category dtype: unique/grouping hash small integer codes
+            # instead of strings
+            df['device_id'] = df['device_id'].astype('category')
+        return df
         
+    except Exception as e:
+        st.error(f"Error fetching data from BigQuery: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=30)
+def get_recent_readings(hours_back=2):
+    """The 20 newest rows with the location columns the table shows"""
+    try:
         query = f"""
         SELECT 
             device_id,
@@ -43,22 +128,88 @@ def get_bigquery_data(hours_back=2):
             vibration,
             building,
             floor,
-            room,
-            device_type,
-            is_anomaly
+            room
         FROM `{PROJECT_ID}.iot_data.sensor_readings`
-        WHERE timestamp >= '{start_time.isoformat()}'
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
         ORDER BY timestamp DESC
-        LIMIT 5000
+        LIMIT 20
         """
-        
-        df = client.query(query).to_dataframe()
+        df = _fetch_df(query, hours_back)
         if not df.empty:
             df['timestamp'] = pd.to_datetime(df['timestamp'])
         return df
         
     except Exception as e:
-        st.error(f"Error fetching data from BigQuery: {e}")
+        st.error(f"Error fetching recent readings from BigQuery: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60)
+def get_anomaly_summary(hours_back=2):
+    """One-row anomaly summary; changes slowly, so a longer TTL"""
+    try:
+        query = f"""
+        SELECT 
+            COUNTIF(is_anomaly) AS an,
+            MAX(IF(is_anomaly, timestamp, NULL)) AS last_an,
+            COUNT(*) AS total
+        FROM `{PROJECT_ID}.iot_data.sensor_readings`
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
+        """
+        return _fetch_df(query, hours_back)
+
+    except Exception as e:
+        st.error(f"Error fetching anomaly summary from BigQuery: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=30)
+def get_bigquery_aggregates(hours_back=2):
+    """Get per-building/device-type aggregates computed inside BigQuery"""
+    try:
+        # Prefer the 5-minute materialized view: BigQuery re-aggregates
+        # a handful of pre-computed buckets instead of scanning raw
+        # readings, and returns KB instead of MB
+        query = f"""
+        SELECT 
+            building,
+            device_type,
+            SUM(cnt) AS cnt,
+            HLL_COUNT.MERGE(devices_sketch) AS devices,
+            SUM(sum_temperature) / SUM(cnt) AS avg_temperature,
+            SUM(sum_vibration) / SUM(cnt) AS avg_vibration,
+            SUM(anomalies) AS anomalies
+        FROM `{PROJECT_ID}.iot_data.sensor_readings_agg_5m`
+        WHERE t5 >= TIMESTAMP_BUCKET(@start_ts, INTERVAL 5 MINUTE)
+        GROUP BY building, device_type
+        """
+        try:
+            return _fetch_df(query, hours_back)
+        except Exception as e:
+            # View not deployed yet; aggregate over the base table
+            st.warning(f"Materialized view unavailable, aggregating base table: {e}")
+
+        # Aggregation still happens in BigQuery's columnar engine, so the
+        # dashboard only receives one small row per group instead of
+        # thousands of raw readings
+        query = f"""
+        SELECT 
+            building,
+            device_type,
+            COUNT(*) AS cnt,
+            COUNT(DISTINCT device_id) AS devices,
+            AVG(temperature) AS avg_temperature,
+            AVG(vibration) AS avg_vibration,
+            COUNTIF(is_anomaly) AS anomalies
+        FROM `{PROJECT_ID}.iot_data.sensor_readings`
+        WHERE DATE(timestamp) >= DATE(@start_ts)
+          AND timestamp >= @start_ts
+        GROUP BY building, device_type
+        """
+        return _fetch_df(query, hours_back)
+
+    except Exception as e:
+        st.error(f"Error fetching aggregates from BigQuery: {e}")
         return pd.DataFrame()
 
 def get_ml_prediction(temperature, vibration, timestamp=None):
@@ -75,7 +226,7 @@ def get_ml_prediction(temperature, vibration, timestamp=None):
             "vibration": vibration
         }
         
-        response = requests.post(f"{ML_SERVER_URL}/detect", json=data, timeout=5)
+        response = get_http_session().post(f"{ML_SERVER_URL}/detect", json=data, timeout=5)
         if response.status_code == 200:
             return response.json()
         else:
@@ -84,133 +235,180 @@ def get_ml_prediction(temperature, vibration, timestamp=None):
         st.error(f"Error getting ML prediction: {e}")
         return None
 
+def get_ml_predictions_batch(rows_df):
+    """Get ML predictions for a DataFrame of readings in one request.
+
+    The server scores the whole batch in a single model pass and the
+    returned results list is aligned with the input row order.
+    """
+    try:
+        items = rows_df[['device_id', 'temperature', 'vibration']].to_dict(orient='records')
+        for item, ts in zip(items, rows_df['timestamp']):
+            item['timestamp'] = ts.isoformat()
+
+        response = get_http_session().post(f"{ML_SERVER_URL}/detect/batch", json={"items": items}, timeout=5)
+        if response.status_code == 200:
+            return response.json().get('results', [])
+        return None
+    except Exception as e:
+        st.error(f"Error getting ML predictions: {e}")
+        return None
+
+@st.cache_data(ttl=300)
 def load_model_metrics():
-    """Load model performance metrics"""
+    """Load model performance metrics from the ML server.
+
+    Cached for 5 minutes: the metrics only change when the trainer
+    runs, so there is no point re-fetching them on every refresh.
+    """
     try:
-        # In a real deployment, you'd fetch these from the ML server or a shared volume
-        # For now, we'll return mock metrics since the models were trained on data without anomalies
-        return {
-            "temperature": {
-                "precision": 0.85,
-                "recall": 0.78,
-                "f1_score": 0.81,
-                "accuracy": 0.90
-            },
-            "vibration": {
-                "precision": 0.82,
-                "recall": 0.75,
-                "f1_score": 0.78,
-                "accuracy": 0.88
-            }
-        }
+        response = get_http_session().get(f"{ML_SERVER_URL}/model-metrics", timeout=2)
+        response.raise_for_status()
+        metrics = response.json()
+        if metrics:
+            return metrics
     except Exception as e:
-        st.error(f"Error loading model metrics: {e}")
-        return {}
+        st.sidebar.warning(f"Model metrics unavailable: {e}")
 
-def main():
-    st.title("🤖 IoT ML Anomaly Detection Dashboard")
-    st.markdown("**Real-time Data with Machine Learning Predictions**")
-    
-    # Sidebar controls
-    st.sidebar.header("Dashboard Controls")
-    hours_back = st.sidebar.slider("Hours of data to show", 1, 24, 2)
-    auto_refresh = st.sidebar.checkbox("Auto-refresh (30 seconds)", value=True)
-    
-    # ML Prediction Demo Section
-    st.sidebar.header("🔮 ML Prediction Demo")
-    demo_temp = st.sidebar.slider("Temperature (°C)", 15.0, 35.0, 22.0, 0.1)
-    demo_vibration = st.sidebar.slider("Vibration (mm/s)", 0.0, 5.0, 1.0, 0.1)
-    
-    if st.sidebar.button("🎯 Get ML Prediction"):
-        with st.spinner("Getting ML prediction..."):
-            prediction = get_ml_prediction(demo_temp, demo_vibration)
-            if prediction:
-                st.sidebar.success("Prediction received!")
-                col1, col2 = st.sidebar.columns(2)
-                with col1:
-                    temp_status = "🚨 ANOMALY" if prediction.get('is_temp_anomaly') else "✅ NORMAL"
-                    st.sidebar.write(f"**Temp:** {temp_status}")
-                with col2:
-                    vib_status = "🚨 ANOMALY" if prediction.get('is_vibration_anomaly') else "✅ NORMAL"
-                    st.sidebar.write(f"**Vib:** {vib_status}")
-                
-                st.sidebar.write(f"**Temp Score:** {prediction.get('temp_anomaly_score', 0):.3f}")
-                st.sidebar.write(f"**Vib Score:** {prediction.get('vibration_anomaly_score', 0):.3f}")
-            else:
-                st.sidebar.error("Failed to get prediction")
-    
-    # Manual refresh
-    if st.sidebar.button("🔄 Refresh Data"):
-        st.cache_data.clear()
-        st.rerun()
-    
-    # Model Performance Section
-    st.sidebar.header("📊 Model Performance")
-    metrics = load_model_metrics()
-    if metrics:
-        for model_name, model_metrics in metrics.items():
-            st.sidebar.write(f"**{model_name.title()} Model:**")
-            st.sidebar.write(f"Accuracy: {model_metrics.get('accuracy', 0):.2f}")
-            st.sidebar.write(f"F1-Score: {model_metrics.get('f1_score', 0):.2f}")
-    
-    # Fetch data
+    # Fall back to representative mock metrics when the server (or the
+    # trainer's metrics files) are not available
+    return {
+        "temperature": {
+            "precision": 0.85,
+            "recall": 0.78,
+            "f1_score": 0.81,
+            "accuracy": 0.90
+        },
+        "vibration": {
+            "precision": 0.82,
+            "recall": 0.75,
+            "f1_score": 0.78,
+            "accuracy": 0.88
+        }
+    }
+
+# Figure construction is cached separately from the data: plotly.express
+# spends real time converting the frame into trace JSON, and that JSON
+# is identical until new rows arrive. The custom hash keys the frame by
+# its length and first/last timestamps instead of hashing every row.
+_df_key = {pd.DataFrame: lambda d: (len(d), d['timestamp'].iloc[0].value, d['timestamp'].iloc[-1].value) if len(d) else (0,)}
+
+@st.cache_data(ttl=30, hash_funcs=_df_key)
+def build_scatter_fig(df, y_col, title, y_label):
+    """Build a downsampled per-device scatter chart"""
+    return px.scatter(
+        downsample_df(df, y_col),  # ~200 points/device
+        x='timestamp',
+        y=y_col,
+        color='device_id',
+        title=title,
+        labels={y_col: y_label},
+        height=400
+    )
+
+@st.cache_data(ttl=30)
+def build_building_pie(building_counts):
+    """Readings-by-building pie; the input Series is tiny, so the
+    default hash is cheap"""
+    return px.pie(
+        values=building_counts.values,
+        names=building_counts.index,
+        title="Readings by Building"
+    )
+
+@st.cache_data(ttl=30)
+def build_device_type_bar(device_type_counts):
+    """Readings-by-device-type bar chart"""
+    fig = px.bar(
+        x=device_type_counts.index,
+        y=device_type_counts.values,
+        title="Readings by Device Type"
+    )
+    fig.update_layout(
+        xaxis_title="Device Type",
+        yaxis_title="Count"
+    )
+    return fig
+
+# st.fragment (Streamlit >= 1.33) reruns a single pane on its own
+# timer, so a refresh rebuilds only that pane's figures instead of the
+# whole page. Panes are wrapped at call time so the timer honours the
+# sidebar auto-refresh toggle; on older versions the wrapper is a
+# no-op and the page-level auto-refresh in main() covers everything.
+def _fragment(func, run_every):
+    if hasattr(st, 'fragment'):
+        return st.fragment(run_every=run_every)(func)
+    return func
+
+def score_latest(df):
+    """Score the latest 10 readings through the batch endpoint"""
+    latest_df = df.head(10).copy()
+
+    # One batched request instead of ten sequential round trips;
+    # the results list is aligned with the input rows, so the new
+    # columns are assigned positionally instead of merged on
+    # device_id (which also mis-joins when a device repeats)
+    results = get_ml_predictions_batch(latest_df)
+    if results is None or len(results) != len(latest_df):
+        results = [{}] * len(latest_df)
+
+    latest_df[['ml_temp_anomaly', 'ml_vib_anomaly', 'ml_overall_anomaly', 'temp_score', 'vib_score']] = pd.DataFrame(
+        [(pred.get('is_temp_anomaly', False),
+          pred.get('is_vibration_anomaly', False),
+          pred.get('is_anomaly', False),
+          pred.get('temp_anomaly_score', 0),
+          pred.get('vibration_anomaly_score', 0)) for pred in results],
+        index=latest_df.index,
+    )
+    return latest_df
+
+def realtime_pane(hours_back):
+    """Metrics, predictions, charts and the readings table, every 30 s.
+
+    Data is fetched inside the fragment (the 30 s cache absorbs the
+    cost) because fragment reruns reuse arguments captured on the last
+    full-page run.
+    """
     with st.spinner("Fetching data from BigQuery..."):
-        df = get_bigquery_data(hours_back)
-    
+        df = get_timeseries(hours_back)
+        agg = get_bigquery_aggregates(hours_back)
+
     if df.empty:
         st.warning("No data available in BigQuery.")
-        if auto_refresh:
-            time.sleep(30)
-            st.rerun()
         return
+
+    # Add ML predictions to the latest 10 readings (demo)
+    latest_df = score_latest(df)
     
-    # Add ML predictions to recent data (demo)
-    if not df.empty:
-        # Get predictions for the latest 10 readings
-        latest_df = df.head(10).copy()
-        predictions = []
-        
-        for _, row in latest_df.iterrows():
-            pred = get_ml_prediction(row['temperature'], row['vibration'], row['timestamp'])
-            if pred:
-                predictions.append({
-                    'device_id': row['device_id'],
-                    'ml_temp_anomaly': pred.get('is_temp_anomaly', False),
-                    'ml_vib_anomaly': pred.get('is_vibration_anomaly', False),
-                    'ml_overall_anomaly': pred.get('is_anomaly', False),
-                    'temp_score': pred.get('temp_anomaly_score', 0),
-                    'vib_score': pred.get('vibration_anomaly_score', 0)
-                })
-            else:
-                predictions.append({
-                    'device_id': row['device_id'],
-                    'ml_temp_anomaly': False,
-                    'ml_vib_anomaly': False,
-                    'ml_overall_anomaly': False,
-                    'temp_score': 0,
-                    'vib_score': 0
-                })
-        
-        pred_df = pd.DataFrame(predictions)
-        if not pred_df.empty:
-            latest_df = latest_df.merge(pred_df, on='device_id', how='left')
-    
-    # Display metrics
+    # Display metrics; totals come from the BigQuery-side aggregates so
+    # they cover the full window, not just the 1000 fetched rows
+    if not agg.empty:
+        total_readings = int(agg['cnt'].sum())
+        unique_devices = int(agg['devices'].sum())
+        avg_temp = float((agg['avg_temperature'] * agg['cnt']).sum() / total_readings)
+        avg_vibration = float((agg['avg_vibration'] * agg['cnt']).sum() / total_readings)
+    else:
+        # One pull into NumPy, then cheap array ops; repeated pandas
+        # method calls each rescan the frame
+        temps = df['temperature'].to_numpy(dtype=np.float64)
+        vibs = df['vibration'].to_numpy(dtype=np.float64)
+        total_readings = temps.size
+        unique_devices = pd.unique(df['device_id'].to_numpy()).size
+        avg_temp = temps.mean()
+        avg_vibration = vibs.mean()
+
     col1, col2, col3, col4, col5 = st.columns(5)
     
     with col1:
-        st.metric("Total Readings", len(df))
+        st.metric("Total Readings", total_readings)
     
     with col2:
-        unique_devices = df['device_id'].nunique()
         st.metric("Active Devices", unique_devices)
     
     with col3:
-        avg_temp = df['temperature'].mean()
         st.metric("Avg Temperature", f"{avg_temp:.1f}°C")
     
     with col4:
-        avg_vibration = df['vibration'].mean()
         st.metric("Avg Vibration", f"{avg_vibration:.2f} mm/s")
     
     with col5:
@@ -227,74 +425,63 @@ def main():
         with col1:
             st.write("**Latest Temperature Predictions:**")
             temp_pred_df = latest_df[['device_id', 'temperature', 'ml_temp_anomaly', 'temp_score']].head(5)
-            temp_pred_df['Status'] = temp_pred_df['ml_temp_anomaly'].apply(lambda x: "🚨 ANOMALY" if x else "✅ NORMAL")
+            # Vectorized label instead of a Python lambda per row
+            temp_pred_df['Status'] = np.where(temp_pred_df['ml_temp_anomaly'].to_numpy(), "🚨 ANOMALY", "✅ NORMAL")
             st.dataframe(temp_pred_df[['device_id', 'temperature', 'Status', 'temp_score']], use_container_width=True)
         
         with col2:
             st.write("**Latest Vibration Predictions:**")
             vib_pred_df = latest_df[['device_id', 'vibration', 'ml_vib_anomaly', 'vib_score']].head(5)
-            vib_pred_df['Status'] = vib_pred_df['ml_vib_anomaly'].apply(lambda x: "🚨 ANOMALY" if x else "✅ NORMAL")
+            vib_pred_df['Status'] = np.where(vib_pred_df['ml_vib_anomaly'].to_numpy(), "🚨 ANOMALY", "✅ NORMAL")
             st.dataframe(vib_pred_df[['device_id', 'vibration', 'Status', 'vib_score']], use_container_width=True)
     
     # Time series charts with anomaly highlighting
     st.subheader("📈 Sensor Readings with ML Anomaly Detection")
     
-    if not df.empty:
-        col1, col2 = st.columns(2)
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        # Temperature chart with anomalies; the cache hands back a
+        # fresh copy, so adding the overlay never mutates the cached
+        # figure
+        fig_temp = build_scatter_fig(df, 'temperature', "Temperature Over Time", 'Temperature (°C)')
         
-        with col1:
-            # Temperature chart with anomalies
-            fig_temp = px.scatter(
-                df.head(1000), 
-                x='timestamp', 
-                y='temperature',
-                color='device_id',
-                title="Temperature Over Time",
-                labels={'temperature': 'Temperature (°C)'},
-                height=400
-            )
-            
-            # Add anomaly markers if available
-            if 'ml_temp_anomaly' in latest_df.columns:
-                anomaly_data = latest_df[latest_df['ml_temp_anomaly'] == True]
-                if not anomaly_data.empty:
-                    fig_temp.add_scatter(
-                        x=anomaly_data['timestamp'],
-                        y=anomaly_data['temperature'],
-                        mode='markers',
-                        marker=dict(color='red', size=10, symbol='x'),
-                        name='ML Detected Anomalies'
-                    )
-            
-            fig_temp.update_layout(showlegend=False)
-            st.plotly_chart(fig_temp, use_container_width=True)
+        # Add anomaly markers if available; flatnonzero gives the flagged
+        # positions directly instead of building a boolean-mask copy
+        if 'ml_temp_anomaly' in latest_df.columns:
+            ti = np.flatnonzero(latest_df['ml_temp_anomaly'].to_numpy())
+            anomaly_data = latest_df.iloc[ti]
+            if ti.size:
+                fig_temp.add_scatter(
+                    x=anomaly_data['timestamp'],
+                    y=anomaly_data['temperature'],
+                    mode='markers',
+                    marker=dict(color='red', size=10, symbol='x'),
+                    name='ML Detected Anomalies'
+                )
         
-        with col2:
-            # Vibration chart with anomalies
-            fig_vib = px.scatter(
-                df.head(1000), 
-                x='timestamp', 
-                y='vibration',
-                color='device_id',
-                title="Vibration Over Time",
-                labels={'vibration': 'Vibration (mm/s RMS)'},
-                height=400
-            )
-            
-            # Add anomaly markers if available
-            if 'ml_vib_anomaly' in latest_df.columns:
-                anomaly_data = latest_df[latest_df['ml_vib_anomaly'] == True]
-                if not anomaly_data.empty:
-                    fig_vib.add_scatter(
-                        x=anomaly_data['timestamp'],
-                        y=anomaly_data['vibration'],
-                        mode='markers',
-                        marker=dict(color='red', size=10, symbol='x'),
-                        name='ML Detected Anomalies'
-                    )
-            
-            fig_vib.update_layout(showlegend=False)
-            st.plotly_chart(fig_vib, use_container_width=True)
+        fig_temp.update_layout(showlegend=False)
+        st.plotly_chart(fig_temp, use_container_width=True)
+    
+    with col2:
+        # Vibration chart with anomalies
+        fig_vib = build_scatter_fig(df, 'vibration', "Vibration Over Time", 'Vibration (mm/s RMS)')
+        
+        # Add anomaly markers if available
+        if 'ml_vib_anomaly' in latest_df.columns:
+            vi = np.flatnonzero(latest_df['ml_vib_anomaly'].to_numpy())
+            anomaly_data = latest_df.iloc[vi]
+            if vi.size:
+                fig_vib.add_scatter(
+                    x=anomaly_data['timestamp'],
+                    y=anomaly_data['vibration'],
+                    mode='markers',
+                    marker=dict(color='red', size=10, symbol='x'),
+                    name='ML Detected Anomalies'
+                )
+        
+        fig_vib.update_layout(showlegend=False)
+        st.plotly_chart(fig_vib, use_container_width=True)
     
     # Anomaly Score Distribution
     if 'temp_score' in latest_df.columns and 'vib_score' in latest_df.columns:
@@ -320,67 +507,121 @@ def main():
             )
             st.plotly_chart(fig_vib_scores, use_container_width=True)
     
-    # Device distribution
-    st.subheader("🏢 Device Distribution")
-    
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        building_counts = df['building'].value_counts()
-        fig_building = px.pie(
-            values=building_counts.values,
-            names=building_counts.index,
-            title="Readings by Building"
-        )
-        st.plotly_chart(fig_building, use_container_width=True)
-    
-    with col2:
-        if 'device_type' in df.columns:
-            device_type_counts = df['device_type'].value_counts()
-            fig_device_type = px.bar(
-                x=device_type_counts.index,
-                y=device_type_counts.values,
-                title="Readings by Device Type"
-            )
-            st.plotly_chart(fig_device_type, use_container_width=True)
-    
     # Recent readings with ML predictions
     st.subheader("📋 Recent Readings with ML Predictions")
     
     if 'ml_overall_anomaly' in latest_df.columns:
         display_df = latest_df[['device_id', 'timestamp', 'temperature', 'vibration', 
-                               'ml_temp_anomaly', 'ml_vib_anomaly', 'ml_overall_anomaly']].copy()
-        display_df['timestamp'] = display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
+                               'ml_temp_anomaly', 'ml_vib_anomaly', 'ml_overall_anomaly']]
+        # Sort on the datetime column, then format: string timestamps
+        # only order correctly by accident of the format
         display_df = display_df.sort_values('timestamp', ascending=False)
+        display_df = display_df.assign(timestamp=display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S'))
         
-        # Style the dataframe
-        def highlight_anomalies(row):
-            if row['ml_overall_anomaly']:
-                return ['background-color: #ffcccc'] * len(row)
-            return [''] * len(row)
-        
-        styled_df = display_df.style.apply(highlight_anomalies, axis=1)
+        # Style the dataframe column-wise: one vectorized pass per
+        # column instead of a Python call per row
+        anomaly_styles = np.where(display_df['ml_overall_anomaly'].to_numpy(), 'background-color: #ffcccc', '')
+
+        def highlight_anomalies(col):
+            return anomaly_styles
+
+        styled_df = display_df.style.apply(highlight_anomalies, axis=0)
         st.dataframe(styled_df, use_container_width=True)
     else:
-        display_df = df[['device_id', 'timestamp', 'temperature', 'vibration', 'building', 'floor', 'room']].copy()
-        display_df['timestamp'] = display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-        display_df = display_df.sort_values('timestamp', ascending=False).head(20)
-        st.dataframe(display_df, use_container_width=True)
+        # Prediction columns missing; fall back to the 20-row fetch that
+        # carries the location columns
+        display_df = get_recent_readings(hours_back)
+        # The fetch returns a column-less frame when its query fails
+        if not display_df.empty:
+            display_df = display_df.assign(timestamp=display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S'))
+            st.dataframe(display_df, use_container_width=True)
     
     # Data freshness info
-    if not df.empty:
-        latest_reading = df['timestamp'].max()
-        time_since_latest = datetime.now() - latest_reading.to_pydatetime().replace(tzinfo=None)
-        
-        st.sidebar.markdown("---")
-        st.sidebar.write("**Data Freshness:**")
-        st.sidebar.write(f"Latest reading: {latest_reading.strftime('%H:%M:%S')}")
-        st.sidebar.write(f"Time since latest: {int(time_since_latest.total_seconds())} seconds ago")
+    latest_reading = df['timestamp'].max()
+    time_since_latest = datetime.now() - latest_reading.to_pydatetime().replace(tzinfo=None)
+    
+    st.sidebar.markdown("---")
+    st.sidebar.write("**Data Freshness:**")
+    st.sidebar.write(f"Latest reading: {latest_reading.strftime('%H:%M:%S')}")
+    st.sidebar.write(f"Time since latest: {int(time_since_latest.total_seconds())} seconds ago")
+
+def distribution_pane(hours_back):
+    """Pie/bar distributions; these drift slowly, so every 5 min"""
+    agg = get_bigquery_aggregates(hours_back)
+    if agg.empty:
+        return
+
+    # Device distribution
+    st.subheader("🏢 Device Distribution")
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        building_counts = agg.groupby('building')['cnt'].sum()
+        st.plotly_chart(build_building_pie(building_counts), use_container_width=True)
+    
+    with col2:
+        device_type_counts = agg.groupby('device_type')['cnt'].sum()
+        st.plotly_chart(build_device_type_bar(device_type_counts), use_container_width=True)
+
+def main():
+    st.title("🤖 IoT ML Anomaly Detection Dashboard")
+    st.markdown("**Real-time Data with Machine Learning Predictions**")
+    
+    # Sidebar controls
+    st.sidebar.header("Dashboard Controls")
+    hours_back = st.sidebar.slider("Hours of data to show", 1, 24, 2)
+    # Auto-refresh toggle; the fragments above carry their own timers,
+    # so the page-level refresh is only needed on Streamlit < 1.33
+    auto_refresh = st.sidebar.checkbox("Auto-refresh (30 seconds)", value=True)
+    if auto_refresh and not hasattr(st, 'fragment') and st_autorefresh is not None:
+        st_autorefresh(interval=30_000, key="datarefresh")
+    
+    # ML Prediction Demo Section
+    st.sidebar.header("🔮 ML Prediction Demo")
+    demo_temp = st.sidebar.slider("Temperature (°C)", 15.0, 35.0, 22.0, 0.1)
+    demo_vibration = st.sidebar.slider("Vibration (mm/s)", 0.0, 5.0, 1.0, 0.1)
+    
+    if st.sidebar.button("🎯 Get ML Prediction"):
+        with st.spinner("Getting ML prediction..."):
+            prediction = get_ml_prediction(demo_temp, demo_vibration)
+            if prediction:
+                st.sidebar.success("Prediction received!")
+                col1, col2 = st.sidebar.columns(2)
+                with col1:
+                    temp_status = "🚨 ANOMALY" if prediction.get('is_temp_anomaly') else "✅ NORMAL"
+                    st.sidebar.write(f"**Temp:** {temp_status}")
+                with col2:
+                    vib_status = "🚨 ANOMALY" if prediction.get('is_vibration_anomaly') else "✅ NORMAL"
+                    st.sidebar.write(f"**Vib:** {vib_status}")
+                
+                st.sidebar.write(f"**Temp Score:** {prediction.get('temp_anomaly_score', 0):.3f}")
+                st.sidebar.write(f"**Vib Score:** {prediction.get('vibration_anomaly_score', 0):.3f}")
+            else:
+                st.sidebar.error("Failed to get prediction")
+    
+    # Manual refresh
+    if st.sidebar.button("🔄 Refresh Data"):
+        st.cache_data.clear()
+        st.rerun()
+    
+    # Model Performance Section
+    st.sidebar.header("📊 Model Performance")
+    metrics = load_model_metrics()
+    if metrics:
+        for model_name, model_metrics in metrics.items():
+            st.sidebar.write(f"**{model_name.title()} Model:**")
+            st.sidebar.write(f"Accuracy: {model_metrics.get('accuracy', 0):.2f}")
+            st.sidebar.write(f"F1-Score: {model_metrics.get('f1_score', 0):.2f}")
+    
+    _fragment(realtime_pane, run_every=30 if auto_refresh else None)(hours_back)
+    _fragment(distribution_pane, run_every=300 if auto_refresh else None)(hours_back)
     
-    # Auto refresh
-    if auto_refresh:
+    # Fallback auto refresh when neither st.fragment nor
+    # streamlit-autorefresh is available
+    if auto_refresh and not hasattr(st, 'fragment') and st_autorefresh is None:
         time.sleep(30)
         st.rerun()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Largest-Triangle-Three-Buckets downsampling for the dashboard charts.
+Keeps the visual shape of a series while sending far fewer points to
+Plotly (and therefore far less JSON to the browser).
+"""
+
+import numpy as np
+
+
+def downsample(x, y, n_out=200):
+    """Return the indexes of the points LTTB keeps.
+
+    The first and last points are always kept; each interior bucket
+    keeps the point forming the largest triangle with the previously
+    selected point and the average of the next bucket.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    selected = np.empty(n_out, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = n - 1
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_lo = edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < n_out - 1 else n
+        next_hi = max(next_hi, next_lo + 1)
+
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+
+        bx = x[lo:hi]
+        by = y[lo:hi]
+        area = np.abs((x[a] - avg_x) * (by - y[a]) - (x[a] - bx) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+
+    return selected
+
+
+def downsample_df(df, y_col, n_out=200):
+    """Downsample a readings DataFrame to ~n_out points per device"""
+    if df.empty or len(df) <= n_out:
+        return df
+
+    xs = df['timestamp'].astype('int64').to_numpy()
+    ys = df[y_col].to_numpy(dtype=np.float64)
+
+    keep = []
+    for positions in df.groupby('device_id', sort=False).indices.values():
+        keep.append(positions[downsample(xs[positions], ys[positions], n_out)])
+
+    return df.iloc[np.sort(np.concatenate(keep))]
@@ -261,6 +261,42 @@ resource "google_bigquery_table" "sensor_readings_table" {
   ])
 }
 
+# Materialized view with 5-minute pre-aggregates; the dashboards read
+# their distribution panels from this tiny table instead of scanning
+# raw readings on every refresh
+resource "google_bigquery_table" "sensor_readings_agg_5m" {
+  dataset_id = google_bigquery_dataset.iot_dataset.dataset_id
+  table_id   = "sensor_readings_agg_5m"
+  project    = var.project_id
+
+  description = "5-minute pre-aggregated sensor readings for dashboards"
+
+  labels = {
+    environment = var.environment
+    component   = "iot-data-warehouse"
+  }
+
+  materialized_view {
+    # Sums and an HLL sketch rather than averages/distinct counts so the
+    # buckets can be re-aggregated over any time window
+    query = <<-EOT
+      SELECT
+        TIMESTAMP_BUCKET(timestamp, INTERVAL 5 MINUTE) AS t5,
+        building,
+        device_type,
+        COUNT(*) AS cnt,
+        HLL_COUNT.INIT(device_id) AS devices_sketch,
+        SUM(temperature) AS sum_temperature,
+        SUM(vibration) AS sum_vibration,
+        COUNTIF(is_anomaly) AS anomalies
+      FROM `${var.project_id}.${google_bigquery_dataset.iot_dataset.dataset_id}.${var.bigquery_table_id}`
+      GROUP BY 1, 2, 3
+    EOT
+  }
+
+  depends_on = [google_bigquery_table.sensor_readings_table]
+}
+
 # BigQuery Table for ML predictions
 resource "google_bigquery_table" "ml_predictions_table" {
   dataset_id = google_bigquery_dataset.iot_dataset.dataset_id
@@ -4,61 +4,155 @@ System tests for the IoT anomaly detection system
 """
 
 import unittest
+import importlib.util
 import json
 import os
+import sys
 from datetime import datetime
-import numpy as np
+from functools import lru_cache
+
+# Guarded like the project modules below: a unit-test-only CI job
+# without the scientific stack should skip these tests, not fail at
+# collection
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+
+# Project modules are imported once per process here instead of inside
+# each test method; a missing dependency (e.g. the google-cloud libs)
+# skips the dependent test rather than failing collection
+try:
+    from simulator.iot_simulator import IoTDeviceSimulator
+except ImportError:
+    IoTDeviceSimulator = None
+
+# The other components live in hyphenated directories that plain
+# `import` cannot name, so they are loaded by file path and registered
+# under underscored aliases; missing third-party dependencies inside a
+# module still surface as ImportError and trip the guards below
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _load_component(name, relpath):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(_REPO_ROOT, relpath))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except ImportError:
+        del sys.modules[name]
+        raise
+    return module
+
+try:
+    IoTDataConsumer = _load_component(
+        'data_consumer', 'data-consumer/consumer.py').IoTDataConsumer
+except ImportError:
+    IoTDataConsumer = None
+
+try:
+    AnomalyDetectionTrainer = _load_component(
+        'ml_trainer', 'ml-trainer/trainer.py').AnomalyDetectionTrainer
+except ImportError:
+    AnomalyDetectionTrainer = None
+
+try:
+    prepare_features = _load_component(
+        'ml_server', 'ml-server/server.py').prepare_features
+except ImportError:
+    prepare_features = None
+
+@lru_cache(maxsize=128)
+def _cached_prepare_features(device_id, timestamp, temperature, vibration):
+    """Memoized server feature preparation for repeated/parametrized
+    runs; prepare_features is pure once the timestamp is pinned"""
+    return prepare_features({
+        "device_id": device_id,
+        "timestamp": timestamp,
+        "temperature": temperature,
+        "vibration": vibration
+    })
 
 class TestIoTSystem(unittest.TestCase):
     
-    def test_simulator_data_generation(self):
-        """Test that the simulator generates valid data"""
-        # Import the simulator module
-        from simulator.iot_simulator import IoTDeviceSimulator
-        
-        # Create a simulator instance
-        simulator = IoTDeviceSimulator(
+    @classmethod
+    def setUpClass(cls):
+        """One shared instance of each component for the whole class.
+
+        The constructors open GCP clients with retries, which is too
+        expensive to repeat for every test; the tests below only read
+        from these fixtures.
+        """
+        cls.simulator = IoTDeviceSimulator(
             project_id="test-project",
             topic_name="test-topic",
             num_devices=5
-        )
+        ) if IoTDeviceSimulator else None
+        cls.consumer = IoTDataConsumer(
+            project_id="test-project",
+            subscription_name="test-subscription"
+        ) if IoTDataConsumer else None
+        cls.trainer = AnomalyDetectionTrainer(
+            project_id="test-project"
+        ) if AnomalyDetectionTrainer else None
+    
+    def test_simulator_data_generation(self):
+        """Test that the simulator generates valid data"""
+        if self.simulator is None:
+            self.skipTest("simulator module unavailable")
+        if pd is None:
+            self.skipTest("pandas unavailable")
         
         # Generate sample data
-        samples = simulator.generate_sample_data(10)
+        samples = self.simulator.generate_sample_data(10)
         
         # Check that we have the expected number of samples
         self.assertEqual(len(samples), 10)
         
-        # Check the structure of each sample
-        for sample in samples:
-            self.assertIn('device_id', sample)
-            self.assertIn('timestamp', sample)
-            self.assertIn('location', sample)
-            self.assertIn('device_type', sample)
-            self.assertIn('sensor_data', sample)
-            self.assertIn('is_anomaly', sample)
-            
-            # Check sensor data structure
-            sensor_data = sample['sensor_data']
-            self.assertIn('temperature', sensor_data)
-            self.assertIn('vibration', sensor_data)
-            
-            # Check that temperature and vibration are reasonable values
-            self.assertGreaterEqual(sensor_data['temperature'], -50)  # Reasonable lower bound
-            self.assertLessEqual(sensor_data['temperature'], 100)     # Reasonable upper bound
-            self.assertGreaterEqual(sensor_data['vibration'], 0)       # Vibration can't be negative
+        # Flatten once and check structure/bounds with vectorized
+        # comparisons instead of a dozen assertions per sample
+        df = pd.json_normalize(samples)
+        self.assertLessEqual(
+            {'device_id', 'timestamp', 'device_type', 'is_anomaly',
+             'sensor_data.temperature', 'sensor_data.vibration'},
+            set(df.columns)
+        )
+        self.assertTrue(any(col.startswith('location') for col in df.columns))
+        
+        # Check that temperature and vibration are reasonable values
+        temperature = df['sensor_data.temperature'].to_numpy()
+        self.assertTrue(((temperature >= -50) & (temperature <= 100)).all())  # Reasonable bounds
+        self.assertTrue((df['sensor_data.vibration'].to_numpy() >= 0).all())  # Vibration can't be negative
             
-    def test_consumer_data_processing(self):
-        """Test that the consumer processes data correctly"""
-        # Import the consumer module
-        from data_consumer.consumer import IoTDataConsumer
+    def test_simulator_vectorized_generation(self):
+        """Test that the vectorized sample generator matches the schema"""
+        if self.simulator is None:
+            self.skipTest("simulator module unavailable")
+        if pd is None:
+            self.skipTest("pandas unavailable")
         
-        # Create a consumer instance
-        consumer = IoTDataConsumer(
-            project_id="test-project",
-            subscription_name="test-subscription"
+        samples = self.simulator.generate_sample_data_np(50)
+        self.assertEqual(len(samples), 50)
+        
+        df = pd.json_normalize(samples)
+        self.assertLessEqual(
+            {'device_id', 'timestamp', 'device_type', 'is_anomaly',
+             'sensor_data.temperature', 'sensor_data.vibration'},
+            set(df.columns)
         )
         
+        temperature = df['sensor_data.temperature'].to_numpy()
+        self.assertTrue(((temperature >= -50) & (temperature <= 100)).all())
+        self.assertTrue((df['sensor_data.vibration'].to_numpy() >= 0).all())
+        
+    def test_consumer_data_processing(self):
+        """Test that the consumer processes data correctly"""
+        if self.consumer is None:
+            self.skipTest("consumer module unavailable")
+        
         # Create a sample message
         sample_message = {
             "device_id": "sensor_0001",
@@ -89,22 +183,21 @@ class TestIoTSystem(unittest.TestCase):
             "is_anomaly": sample_message["is_anomaly"]
         }
         
-        # Check that all expected fields are present
-        expected_fields = [
+        # Check that all expected fields are present; dict KeysView
+        # supports superset comparison, so this is one C-level check
+        expected_fields = {
             "device_id", "timestamp", "building", "floor", 
             "room", "device_type", "temperature", "vibration", "is_anomaly"
-        ]
+        }
         
-        for field in expected_fields:
-            self.assertIn(field, bq_row)
+        self.assertGreaterEqual(bq_row.keys(), expected_fields)
             
     def test_ml_trainer_feature_preparation(self):
         """Test that the ML trainer prepares features correctly"""
-        # Import the trainer module
-        from ml_trainer.trainer import AnomalyDetectionTrainer
-        
-        # Create a trainer instance
-        trainer = AnomalyDetectionTrainer(project_id="test-project")
+        if self.trainer is None:
+            self.skipTest("trainer module unavailable")
+        if pd is None:
+            self.skipTest("pandas unavailable")
         
         # Create sample data
         sample_data = [
@@ -125,11 +218,10 @@ class TestIoTSystem(unittest.TestCase):
         ]
         
         # Convert to format expected by prepare_features
-        import pandas as pd
         df = pd.DataFrame(sample_data)
         
         # Test feature preparation
-        X, df_processed = trainer.prepare_features(df)
+        X, df_processed = self.trainer.prepare_features(df)
         
         # Check that features are created
         self.assertIsNotNone(X)
@@ -147,31 +239,24 @@ class TestIoTSystem(unittest.TestCase):
         
     def test_ml_server_anomaly_detection(self):
         """Test that the ML server detects anomalies correctly"""
-        # Import the server module
-        from ml_server.server import prepare_features
-        
-        # Create sample data
-        sample_data = {
-            "device_id": "sensor_0001",
-            "timestamp": datetime.now().isoformat(),
-            "temperature": 23.5,
-            "vibration": 1.2
-        }
+        if prepare_features is None:
+            self.skipTest("server module unavailable")
         
-        # Test feature preparation
-        features = prepare_features(sample_data)
+        # Test feature preparation through the memoized wrapper
+        features = _cached_prepare_features(
+            "sensor_0001", datetime.now().isoformat(), 23.5, 1.2
+        )
         
         # Check that features are created
         self.assertIsNotNone(features)
         
         # Check that all expected features are present
-        expected_features = [
+        expected_features = {
             'temperature', 'vibration', 'hour', 'day_of_week', 
             'temp_ma', 'vibration_ma', 'temp_zscore', 'vibration_zscore'
-        ]
+        }
         
-        for feature in expected_features:
-            self.assertIn(feature, features)
+        self.assertGreaterEqual(features.keys(), expected_features)
 
 if __name__ == '__main__':
     unittest.main()